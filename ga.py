@@ -65,7 +65,7 @@ class GeneticAlgorithm:
         path1 = np.insert(path1, start, crossoverstring)
         return path1
 
-    def __call__(self):
+    def __call__(self, tsp=None, callback=None, verbose=True):
         """execute a genetic algorithm to optimize the tsp solution.
 
         parameters:
@@ -74,17 +74,23 @@ class GeneticAlgorithm:
             survivalrate (int): the percentage of paths that survive to the next generation.
             mutationrate (int): the percentage of paths that are mutated in the next generation.
             mutationoperator (function): the function used to perform mutations on paths.
+            tsp (callable, optional): route length function with a `dim` attribute, defaults to TSP().
+            callback (function, optional): called as callback(epoch, path, distance) with the best path
+                of every epoch, returning True stops the algorithm early.
+            verbose (bool): whether to print progress.
 
         returns:
             none: this function does not return a value but prints results and plots the best route found.
         """
-        tsp = TSP()
+        if tsp is None:
+            tsp = TSP()
         paths = np.array([np.random.permutation(tsp.dim) for _ in range(self.nPaths)])
         distances = np.array([tsp(path) for path in paths])
         self.history = []
         self.minDist = np.min(distances)
         self.history.append(self.minDist)
-        print(f"initial smallest distance = {self.minDist}\ninitiating genetic algorithm\n")
+        if verbose:
+            print(f"initial smallest distance = {self.minDist}\ninitiating genetic algorithm\n")
         while not self.end():
             # best % survives, unique produces the indexes of distances that produce the sorting of unique items, used to choose the surviving paths
             _, sortingidxs = np.unique(distances, return_index=True)
@@ -108,11 +114,13 @@ class GeneticAlgorithm:
             else:
                 self.unchangedIterations += 1
             # print status once every 50 epochs and update epoch
-            if (not self.epoch % 50):
+            if verbose and (not self.epoch % 50):
                 print(f'epoch {self.epoch}...')
                 print(f'smallest distance = {newMin}')
             self.epoch += 1
             self.history.append(newMin)
+            if callback is not None and callback(self.epoch, paths[np.argmin(distances)], newMin):
+                break
         self.bestRoute = paths[np.argmin(distances)]
         self.bestDistance = np.min(distances)
     def plotPath(self):
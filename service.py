@@ -0,0 +1,528 @@
+"""Local job service for solving many TSP instances concurrently.
+
+An asyncio front end hands solve requests to a warm pool of worker processes.
+Clients submit an instance plus solver config, get a job id back, can stream the
+intermediate best tours and lengths, and can cancel a job or give it a deadline.
+Distance matrices are computed and cached once on the front end and sent along
+with every job, so identical instances share the haversine precomputation no
+matter which worker ends up solving them.
+
+A finished job is forgotten `retention` seconds after its result or its full
+stream has been read. Finished jobs nobody reads are kept until more than
+`maxUnread` of them pile up, then the oldest ones are forgotten first.
+
+Example
+-------
+    async def main():
+        async with JobService(maxWorkers=4) as service:
+            jobId = await service.submit(config={"endParameterMax": 500}, deadline=10)
+            async for epoch, route, distance in service.stream(jobId):
+                print(epoch, distance)
+            route, distance = await service.result(jobId)
+
+    if __name__ == "__main__":
+        asyncio.run(main())
+"""
+
+import asyncio
+import concurrent.futures
+import functools
+import inspect
+import multiprocessing
+import os
+import time
+import uuid
+
+from tsp import *
+from ga import GeneticAlgorithm
+
+# solvers that can be requested by name, all of them are constructed with the
+# config as keyword arguments and called with (tsp, callback, verbose)
+SOLVERS = {
+    "ga": GeneticAlgorithm,
+}
+
+# maximum number of unfinished jobs, every one of them needs a stop flag
+MAX_JOBS = 10_000
+
+# improvements kept per job until they are streamed, older ones are dropped first
+MAX_PENDING_IMPROVEMENTS = 100
+
+# end of stream marker, as put on the queue of a job
+END_OF_STREAM = (None, None, None)
+
+_progressQueue = None
+_stopFlags = None
+
+
+class MatrixTSP:
+    """Route length function over a precomputed distance matrix, a drop in for TSP.__call__"""
+
+    def __init__(self, distances: np.ndarray):
+        """Create a route length function
+
+        Parameters
+        ----------
+        distances: np.ndarray
+            (n + 1) x (n + 1) matrix of distances, with Leiden at index 0 and city i at index i + 1
+        """
+
+        self.distances = distances
+        self.dim = len(distances) - 1
+
+    def __call__(self, path_idx: np.ndarray) -> float:
+        """Calculate the length of the tour given by path_idx, starting and ending in Leiden"""
+
+        assert len(path_idx) == self.dim, "Make sure you visit all cities"
+        assert len(set(path_idx)) == len(path_idx), "Make sure all cities are unique"
+
+        stops = np.concatenate(([0], np.asarray(path_idx, dtype=int) + 1, [0]))
+        return float(self.distances[stops[:-1], stops[1:]].sum())
+
+
+@functools.lru_cache(maxsize=1)
+def defaultCities() -> typing.Tuple[typing.Tuple[float, float], ...]:
+    """The (lng, lat) pairs of the capitals of TSP, in the same order"""
+    tsp = TSP(plot=False)
+    return tuple(map(tuple, tsp.create_path(range(tsp.dim))[1:-1].tolist()))
+
+
+@functools.lru_cache(maxsize=32)
+def distanceMatrix(cities: typing.Tuple[typing.Tuple[float, float], ...]) -> np.ndarray:
+    """Compute (and cache) the distance matrix of an instance
+
+    Parameters
+    ----------
+    cities: tuple
+        (lng, lat) pairs of the cities
+
+    Returns
+    -------
+        np.ndarray
+            The distance matrix, with Leiden at index 0 and city i at index i + 1
+    """
+    points = np.vstack([LEIDEN, np.asarray(cities, dtype=float).reshape(-1, 2)])
+    n = len(points)
+    distances = np.zeros((n, n))
+    for i in range(n):
+        for j in range(i + 1, n):
+            # same argument order as TSP.__call__, so route lengths agree with it
+            distances[i, j] = distances[j, i] = haversine(*points[i], *points[j])
+    distances.setflags(write=False)
+    return distances
+
+
+def _initWorker(progressQueue, stopFlags):
+    """Runs once in every worker process, stores the progress queue and the stop flags"""
+    global _progressQueue, _stopFlags
+    _progressQueue = progressQueue
+    _stopFlags = stopFlags
+
+
+def _solve(jobId, slot, distances, solver, config):
+    """Run one job inside a worker process.
+
+    Every improvement of the best route is put on the progress queue as
+    (jobId, epoch, route, distance), followed by (jobId, None, None, None) when the
+    job is finished. The solver stops early as soon as the stop flag in slot is set.
+    """
+    best = {"route": None, "distance": float("inf")}
+
+    def callback(epoch, path, distance):
+        if distance < best["distance"]:
+            best["route"], best["distance"] = path.tolist(), float(distance)
+            _progressQueue.put((jobId, epoch, best["route"], best["distance"]))
+        return bool(_stopFlags[slot])
+
+    try:
+        if not _stopFlags[slot]:
+            algorithm = SOLVERS[solver](**config)
+            algorithm(tsp=MatrixTSP(distances), callback=callback, verbose=False)
+            if algorithm.bestDistance < best["distance"]:
+                best["route"], best["distance"] = algorithm.bestRoute.tolist(), float(algorithm.bestDistance)
+    finally:
+        _progressQueue.put((jobId, *END_OF_STREAM))
+    return best["route"], best["distance"]
+
+
+class Job:
+    """Bookkeeping of a single submitted job on the asyncio side"""
+
+    def __init__(self, jobId, slot, stopFlags, pool):
+        self.jobId = jobId
+        self.slot = slot
+        self.stopFlags = stopFlags
+        self.pool = pool
+        self.status = "running"
+        self.future = None
+        self.progress = asyncio.Queue(MAX_PENDING_IMPROVEMENTS)
+        self.streamEnded = False
+        self.deadlineHandle = None
+        self.dropHandle = None
+
+    def stop(self, status):
+        """Ask the worker to stop and return the best route found so far"""
+        if self.status == "running":
+            self.status = status
+        if self.slot is not None:
+            self.stopFlags[self.slot] = 1
+
+    def push(self, message):
+        """Queue a message for the stream, dropping the oldest improvement when full"""
+        if self.progress.full():
+            self.progress.get_nowait()
+        self.progress.put_nowait(message)
+
+
+class JobService:
+    """Asyncio front end over a warm process pool of TSP solvers"""
+
+    def __init__(self, maxWorkers: int = None, retention: float = 60.0, maxUnread: int = 10_000):
+        """Create a job service, use it as an async context manager to start and stop the pool
+
+        Parameters
+        ----------
+        maxWorkers: int (optional)
+            Number of worker processes, defaults to the number of processors
+        retention: float = 60.0
+            Seconds a finished job is kept around after its result or stream has been read
+        maxUnread: int = 10_000
+            Number of finished jobs kept around that nobody has read yet
+        """
+
+        self.maxWorkers = maxWorkers or os.cpu_count()
+        self.retention = retention
+        self.maxUnread = maxUnread
+        self.jobs = {}
+        self.unread = {}
+        self.freeSlots = list(range(MAX_JOBS))
+        self.stopFlags = None
+        self.manager = None
+        self.pool = None
+        self.warmup = None
+        self.pump = None
+
+    async def __aenter__(self):
+        """Start the worker processes and wait until all of them are warm."""
+
+        loop = asyncio.get_running_loop()
+        self.manager = multiprocessing.Manager()
+        self.progressQueue = self.manager.Queue()
+        self.stopFlags = multiprocessing.RawArray("b", MAX_JOBS)
+        self.pool = self._createPool()
+        await self._warmPool(self.pool)
+        await loop.run_in_executor(None, distanceMatrix, defaultCities())
+        self.pump = loop.create_task(self._pumpProgress())
+        return self
+
+    async def __aexit__(self, *args, **kwargs):
+        """Stop all running jobs and shut down the worker processes."""
+
+        for job in list(self.jobs.values()):
+            job.stop("cancelled")
+        pool, self.pool = self.pool, None
+        if self.warmup is not None:
+            await asyncio.wait([self.warmup])
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(None, pool.shutdown)
+        self.progressQueue.put(None)
+        await self.pump
+        for job in self.jobs.values():
+            if job.dropHandle is not None:
+                job.dropHandle.cancel()
+        self.jobs.clear()
+        self.unread.clear()
+        self.manager.shutdown()
+
+    def _createPool(self):
+        """Create the process pool of the workers"""
+
+        # don't fork, the front end is running threads (pump, executor) by now
+        if "forkserver" in multiprocessing.get_all_start_methods():
+            context = multiprocessing.get_context("forkserver")
+            # import the heavy modules once in the server, instead of in every worker
+            context.set_forkserver_preload(["tsp", "ga"])
+        else:
+            context = multiprocessing.get_context("spawn")
+        return concurrent.futures.ProcessPoolExecutor(
+            self.maxWorkers,
+            mp_context=context,
+            initializer=_initWorker,
+            initargs=(self.progressQueue, self.stopFlags),
+        )
+
+    async def _warmPool(self, pool):
+        """Wait until all worker processes of a pool are started"""
+
+        # the pool only spawns processes on demand, so push a no-op through every worker
+        loop = asyncio.get_running_loop()
+        await asyncio.gather(
+            *[loop.run_in_executor(pool, int) for _ in range(self.maxWorkers)], return_exceptions=True
+        )
+
+    def _replacePool(self, broken):
+        """Replace a pool of which a worker died, unless that already happened"""
+
+        if self.pool is broken:
+            broken.shutdown(wait=False)
+            self.pool = self._createPool()
+            self.warmup = asyncio.get_running_loop().create_task(self._warmPool(self.pool))
+
+    async def _pumpProgress(self):
+        """Move progress messages from the worker processes to the queue of their job"""
+
+        loop = asyncio.get_running_loop()
+        while True:
+            message = await loop.run_in_executor(None, self.progressQueue.get)
+            if message is None:
+                return
+            job = self.jobs.get(message[0])
+            if job is not None:
+                job.push(message[1:])
+
+    async def submit(
+        self,
+        cities: typing.Sequence[typing.Tuple[float, float]] = None,
+        solver: str = "ga",
+        config: dict = None,
+        deadline: float = None,
+    ) -> str:
+        """Submit a TSP instance to be solved.
+
+        Parameters
+        ----------
+        cities: sequence of (lng, lat) (optional)
+            The cities to visit from Leiden, at least 2, defaults to the European capitals of TSP
+        solver: str = "ga"
+            Name of the solver in SOLVERS
+        config: dict (optional)
+            Keyword arguments for the solver
+        deadline: float (optional)
+            Seconds after which the job is stopped and the best route so far is kept
+
+        Returns
+        -------
+            str The job id
+        """
+        if self.pool is None:
+            raise RuntimeError("The service is not running, use it as `async with JobService() as service`")
+        if not self.freeSlots:
+            raise RuntimeError(f"Too many unfinished jobs, at most {MAX_JOBS} can be submitted at once")
+
+        if solver not in SOLVERS:
+            raise ValueError(f"Unknown solver {solver!r}, choose from {list(SOLVERS)}")
+
+        config = dict(config or {})
+        try:
+            inspect.signature(SOLVERS[solver]).bind(**config)
+        except TypeError as error:
+            raise ValueError(f"Invalid config for solver {solver!r}: {error}") from None
+
+        if cities is None:
+            cities = defaultCities()
+        else:
+            cities = tuple((float(lng), float(lat)) for lng, lat in cities)
+        if len(cities) < 2:
+            raise ValueError(f"An instance needs at least 2 cities, got {len(cities)}")
+
+        loop = asyncio.get_running_loop()
+        distances = await loop.run_in_executor(None, distanceMatrix, cities)
+
+        job = Job(uuid.uuid4().hex, self.freeSlots.pop(), self.stopFlags, self.pool)
+        self.stopFlags[job.slot] = 0
+        try:
+            job.future = loop.run_in_executor(job.pool, _solve, job.jobId, job.slot, distances, solver, config)
+        except concurrent.futures.BrokenExecutor:
+            # a worker died before we noticed it through one of the running jobs
+            self._replacePool(job.pool)
+            job.pool = self.pool
+            job.future = loop.run_in_executor(job.pool, _solve, job.jobId, job.slot, distances, solver, config)
+        self.jobs[job.jobId] = job
+        job.future.add_done_callback(functools.partial(self._finish, job))
+        if deadline is not None:
+            job.deadlineHandle = loop.call_later(deadline, job.stop, "expired")
+        return job.jobId
+
+    def _finish(self, job, future):
+        """Update the status of a job once its worker is done"""
+
+        if job.deadlineHandle is not None:
+            job.deadlineHandle.cancel()
+        error = None if future.cancelled() else future.exception()
+        if future.cancelled():
+            job.stop("cancelled")
+        elif job.status == "running":
+            job.status = "failed" if error else "done"
+        if future.cancelled() or isinstance(error, concurrent.futures.BrokenExecutor):
+            # the worker never ran or died, so it never sent the end of the stream
+            job.push(END_OF_STREAM)
+        if isinstance(error, concurrent.futures.BrokenExecutor):
+            self._replacePool(job.pool)
+        # the worker is done with it, so its stop flag can be reused
+        self.freeSlots.append(job.slot)
+        job.slot = None
+        if job.jobId in self.jobs and job.dropHandle is None:
+            self.unread[job.jobId] = None
+            while len(self.unread) > self.maxUnread:
+                oldest = next(iter(self.unread))
+                del self.unread[oldest]
+                self.jobs.pop(oldest, None)
+
+    def _read(self, job):
+        """Start the retention of a job once its result or full stream has been read"""
+
+        self.unread.pop(job.jobId, None)
+        if job.dropHandle is None and job.jobId in self.jobs:
+            job.dropHandle = asyncio.get_running_loop().call_later(self.retention, self.jobs.pop, job.jobId, None)
+
+    def cancel(self, jobId: str) -> None:
+        """Stop a job, its result will be the best route found so far (if any)."""
+
+        job = self.jobs[jobId]
+        job.stop("cancelled")
+
+    def status(self, jobId: str) -> str:
+        """Status of a job, one of running, done, cancelled, expired or failed."""
+
+        return self.jobs[jobId].status
+
+    async def stream(self, jobId: str):
+        """Iterate over the improvements of a job as (epoch, route, distance), until it is finished.
+
+        Every job has a single stream, consuming it from multiple places splits the messages.
+        Streaming a job whose stream has ended returns right away.
+        """
+        job = self.jobs[jobId]
+        while not job.streamEnded:
+            epoch, route, distance = await job.progress.get()
+            if epoch is None:
+                job.streamEnded = True
+                # put the marker back, to wake up any other consumer waiting for it
+                job.push(END_OF_STREAM)
+                # the end of the stream can overtake the future, wait for it so the status is final
+                await asyncio.wait([job.future])
+                self._read(job)
+                return
+            yield epoch, route, distance
+
+    async def result(self, jobId: str) -> typing.Tuple[typing.Optional[list], float]:
+        """Wait for a job and return its (route, distance), route is None if nothing was found."""
+
+        job = self.jobs[jobId]
+        # shield, so a client giving up on waiting doesn't cancel the job itself
+        try:
+            return await asyncio.shield(job.future)
+        finally:
+            if job.future.done():
+                self._read(job)
+
+    def forget(self, jobId: str) -> None:
+        """Drop the bookkeeping of a finished job before its retention is over."""
+
+        job = self.jobs[jobId]
+        assert job.future.done(), "Only finished jobs can be forgotten"
+        if job.dropHandle is not None:
+            job.dropHandle.cancel()
+        self.unread.pop(jobId, None)
+        del self.jobs[jobId]
+
+
+if __name__ == "__main__":
+    # Smoke checks of the service, run as `python service.py`
+
+    async def checks():
+        tsp = TSP(plot=False)
+        matrixTsp = MatrixTSP(distanceMatrix(defaultCities()))
+        for _ in range(10):
+            path = np.random.permutation(tsp.dim)
+            assert np.isclose(matrixTsp(path), tsp(path)), "MatrixTSP should agree with TSP"
+
+        async with JobService(maxWorkers=2, retention=1.0) as service:
+            for cities in ([], [(4.9, 52.4)]):
+                try:
+                    await service.submit(cities=cities)
+                    raise AssertionError("instances with less than 2 cities should be rejected")
+                except ValueError:
+                    pass
+            try:
+                await service.submit(config={"nCities": 3})
+                raise AssertionError("unknown config keys should be rejected")
+            except ValueError:
+                pass
+
+            # a normal job, its status is final as soon as the stream ends
+            jobId = await service.submit(config={"endParameterMax": 100})
+            improvements = [distance async for _, _, distance in service.stream(jobId)]
+            assert service.status(jobId) == "done", service.status(jobId)
+            route, distance = await service.result(jobId)
+            assert sorted(route) == list(range(tsp.dim)) and np.isclose(distance, tsp(route))
+            assert improvements and distance <= improvements[-1]
+            print(f"done: {len(improvements)} improvements, best distance {distance:.2f}")
+
+            # an ended stream stays ended, also for consumers racing for the end of it
+            assert [_ async for _ in service.stream(jobId)] == []
+            jobId = await service.submit(config={"endParameterMax": 100})
+
+            async def drain(jobId):
+                return [improvement async for improvement in service.stream(jobId)]
+
+            await asyncio.wait_for(asyncio.gather(drain(jobId), drain(jobId)), 5)
+
+            # a burst of small jobs, results that are read late are still there
+            start = time.monotonic()
+            jobIds = await asyncio.gather(
+                *[service.submit(cities=defaultCities()[:8], config={"endParameterMax": 20}) for _ in range(200)]
+            )
+            submitted = time.monotonic() - start
+            await asyncio.sleep(1.5)
+            results = await asyncio.gather(*[service.result(jobId) for jobId in jobIds])
+            assert all(sorted(route) == list(range(8)) for route, _ in results)
+            print(f"burst: 200 jobs submitted in {submitted:.2f}s, solved in {time.monotonic() - start - 1.5:.2f}s")
+
+            # giving up on waiting doesn't touch the job, cancelling it stops the worker
+            jobId = await service.submit(config={"endParameterMax": 10**7})
+            try:
+                await asyncio.wait_for(service.result(jobId), 0.3)
+                raise AssertionError("the job should still be running")
+            except asyncio.TimeoutError:
+                pass
+            assert service.status(jobId) == "running", service.status(jobId)
+            service.cancel(jobId)
+            route, distance = await asyncio.wait_for(service.result(jobId), 5)
+            assert service.status(jobId) == "cancelled" and route is not None
+            print(f"cancelled: best distance {distance:.2f}")
+
+            # a deadline stops the job and keeps the best route found so far
+            start = time.monotonic()
+            jobId = await service.submit(cities=defaultCities()[:10], config={"endParameterMax": 10**7}, deadline=0.5)
+            route, distance = await asyncio.wait_for(service.result(jobId), 5)
+            assert service.status(jobId) == "expired" and sorted(route) == list(range(10))
+            print(f"expired after {time.monotonic() - start:.2f}s: best distance {distance:.2f}")
+
+            # a dying worker ends the stream and the pool is replaced
+            jobId = await service.submit(config={"endParameterMax": 10**7})
+            await asyncio.sleep(0.3)
+            for process in list(service.pool._processes.values()):
+                process.kill()
+            await asyncio.wait_for(drain(jobId), 5)
+            assert service.status(jobId) == "failed", service.status(jobId)
+            try:
+                await service.result(jobId)
+                raise AssertionError("the result of a dead worker should raise")
+            except concurrent.futures.BrokenExecutor:
+                pass
+            jobId = await service.submit(config={"endParameterMax": 10})
+            await asyncio.wait_for(service.result(jobId), 5)
+            assert service.status(jobId) == "done"
+            print("worker died: stream ended and the pool was replaced")
+
+            # finished jobs are forgotten after their retention
+            await asyncio.sleep(1.5)
+            assert not service.jobs, service.jobs
+
+            # running jobs are stopped when leaving the service
+            service.cancel(await service.submit(config={"endParameterMax": 10**7}))
+            await service.submit(config={"endParameterMax": 10**7})
+
+    asyncio.run(asyncio.wait_for(checks(), 60))
+    print("all checks passed")